@@ -1,13 +1,19 @@
-from fastapi import FastAPI, Request, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, Request, UploadFile, File, HTTPException, Form, Body
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
 import shutil
-import sqlite3, time, os
+import sqlite3, time, os, asyncio, json, threading, mimetypes
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from argon2 import PasswordHasher
+from PIL import Image
+import numpy as np
+import nibabel as nib
 
 # Add this import at the top with other imports
 from urllib.parse import quote_plus, unquote_plus
@@ -36,8 +42,143 @@ def get_current_user(request: Request):
         row = con.execute("SELECT * FROM user WHERE id = ?", (user_id,)).fetchone()
         return dict(row) if row else None
 
+#######admission control
+# Uploads and heavy endpoints get a limited number of concurrent slots, a bounded wait
+# queue and a per-user in-flight cap. Everything else (login, dashboard, static pages)
+# is never queued, so it stays responsive while large uploads are running.
+# create_patient keeps its SQLite write transaction open while it reads each file, so
+# a second concurrent upload would block on the database lock (on the event loop) and
+# then fail. Uploads are therefore serialised by default and wait in the queue instead.
+ADMISSION_CLASSES = {
+    "upload": {
+        "concurrency": int(os.environ.get("IMAGULATOR_UPLOAD_CONCURRENCY", "1")),
+        "queue": int(os.environ.get("IMAGULATOR_UPLOAD_QUEUE", "8")),
+    },
+    "heavy": {
+        "concurrency": int(os.environ.get("IMAGULATOR_HEAVY_CONCURRENCY", "4")),
+        "queue": int(os.environ.get("IMAGULATOR_HEAVY_QUEUE", "16")),
+    },
+}
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("IMAGULATOR_QUEUE_TIMEOUT", "10"))
+ADMISSION_USER_INFLIGHT = int(os.environ.get("IMAGULATOR_USER_INFLIGHT", "4"))
+ADMISSION_RETRY_AFTER = 5
+
+
+def classify_request(method, path):
+    """Map a request to an admission class, or None for lightweight routes"""
+    if method == "POST" and path == "/new-patient":
+        return "upload"
+    if path.startswith("/api/roi-stats") or path.startswith("/database/Images") or path.startswith("/images/"):
+        return "heavy"
+    return None
+
+
+class AdmissionController:
+    """Slots, wait queues and counters shared by every request of a route class"""
+
+    def __init__(self):
+        self.semaphores = {}
+        self.waiting = {}
+        self.in_flight = {}
+        self.user_in_flight = {}
+        self.counters = {}
+        for name, limits in ADMISSION_CLASSES.items():
+            self.semaphores[name] = asyncio.Semaphore(limits["concurrency"])
+            self.waiting[name] = 0
+            self.in_flight[name] = 0
+            self.counters[name] = {"admitted": 0, "rejected_queue_full": 0,
+                                   "rejected_timeout": 0, "rejected_user_limit": 0}
+
+    def stats(self):
+        return {
+            name: {
+                "in_flight": self.in_flight[name],
+                "queued": self.waiting[name],
+                "concurrency": ADMISSION_CLASSES[name]["concurrency"],
+                "queue_limit": ADMISSION_CLASSES[name]["queue"],
+                **self.counters[name],
+            }
+            for name in ADMISSION_CLASSES
+        }
+
+
+class AdmissionControlMiddleware:
+    """ASGI middleware that admits, queues or rejects requests per route class"""
+
+    def __init__(self, app, controller):
+        self.app = app
+        self.controller = controller
+
+    async def reject(self, scope, receive, send, status_code, message):
+        response = JSONResponse({"error": message}, status_code=status_code,
+                                headers={"Retry-After": str(ADMISSION_RETRY_AFTER)})
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        name = classify_request(scope["method"], scope["path"])
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+
+        ctl = self.controller
+        counters = ctl.counters[name]
+        session = scope.get("session") or {}
+        client = scope.get("client")
+        user_key = session.get("user_id") or (client[0] if client else None)
+
+        if ADMISSION_USER_INFLIGHT and ctl.user_in_flight.get(user_key, 0) >= ADMISSION_USER_INFLIGHT:
+            counters["rejected_user_limit"] += 1
+            await self.reject(scope, receive, send, 429, "Too many requests in progress, please retry shortly")
+            return
+
+        semaphore = ctl.semaphores[name]
+        if semaphore.locked() and ctl.waiting[name] >= ADMISSION_CLASSES[name]["queue"]:
+            counters["rejected_queue_full"] += 1
+            await self.reject(scope, receive, send, 503, "Server busy, please retry shortly")
+            return
+
+        # Count the user as in flight while queued too, so one user cannot fill the queue
+        ctl.user_in_flight[user_key] = ctl.user_in_flight.get(user_key, 0) + 1
+        try:
+            if semaphore.locked():
+                ctl.waiting[name] += 1
+                try:
+                    await asyncio.wait_for(semaphore.acquire(), timeout=ADMISSION_QUEUE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    counters["rejected_timeout"] += 1
+                    await self.reject(scope, receive, send, 503, "Server busy, please retry shortly")
+                    return
+                finally:
+                    ctl.waiting[name] -= 1
+            else:
+                # A free slot is taken without yielding, so bursts cannot overshoot the queue
+                await semaphore.acquire()
+
+            counters["admitted"] += 1
+            ctl.in_flight[name] += 1
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                ctl.in_flight[name] -= 1
+                semaphore.release()
+        finally:
+            ctl.user_in_flight[user_key] -= 1
+            if not ctl.user_in_flight[user_key]:
+                del ctl.user_in_flight[user_key]
+
+
+admission = AdmissionController()
+
 app = FastAPI()
 
+# Admission control is added first so it runs inside the session middleware
+# and can see who is logged in
+app.add_middleware(AdmissionControlMiddleware, controller=admission)
+
 # Add session middleware
 app.add_middleware(SessionMiddleware, secret_key="change-this-secret-key-in-production")
 
@@ -55,6 +196,206 @@ sourPROCESSED_DIR = BASE / "database" / "Images" / "processed"
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 # PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
 
+# Storage quotas in bytes (0 = unlimited), override with environment variables
+DOCTOR_QUOTA_BYTES = int(os.environ.get("IMAGULATOR_DOCTOR_QUOTA_BYTES", "0"))
+PATIENT_QUOTA_BYTES = int(os.environ.get("IMAGULATOR_PATIENT_QUOTA_BYTES", "0"))
+
+
+#######storage accounting
+# Usage totals live in doctor_storage / patient_storage and are kept up to date by
+# triggers on the image table, so they change in the same transaction as the image
+# row and never need a rescan of the upload directory.
+STORAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS doctor_storage (
+    doctor_username TEXT PRIMARY KEY,
+    bytes           INTEGER NOT NULL DEFAULT 0,
+    image_count     INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS patient_storage (
+    patient_id      INTEGER PRIMARY KEY,
+    doctor_username TEXT,
+    bytes           INTEGER NOT NULL DEFAULT 0,
+    image_count     INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS image_storage_insert AFTER INSERT ON image
+BEGIN
+    INSERT INTO patient_storage (patient_id, doctor_username, bytes, image_count)
+    VALUES (NEW.patient_id, (SELECT doctor_username FROM patient WHERE id = NEW.patient_id),
+            NEW.size_bytes, 1)
+    ON CONFLICT(patient_id) DO UPDATE SET doctor_username = excluded.doctor_username,
+                                          bytes = bytes + excluded.bytes,
+                                          image_count = image_count + 1;
+    INSERT INTO doctor_storage (doctor_username, bytes, image_count)
+    SELECT doctor_username, NEW.size_bytes, 1 FROM patient WHERE id = NEW.patient_id
+    ON CONFLICT(doctor_username) DO UPDATE SET bytes = bytes + excluded.bytes,
+                                               image_count = image_count + 1;
+END;
+
+-- The doctor is looked up through patient_storage rather than patient so the totals
+-- stay correct when images are removed by an ON DELETE CASCADE from patient.
+CREATE TRIGGER IF NOT EXISTS image_storage_delete AFTER DELETE ON image
+BEGIN
+    UPDATE doctor_storage
+       SET bytes = bytes - OLD.size_bytes, image_count = image_count - 1
+     WHERE doctor_username = (SELECT doctor_username FROM patient_storage WHERE patient_id = OLD.patient_id);
+    UPDATE patient_storage
+       SET bytes = bytes - OLD.size_bytes, image_count = image_count - 1
+     WHERE patient_id = OLD.patient_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS image_storage_resize AFTER UPDATE OF size_bytes ON image
+BEGIN
+    UPDATE doctor_storage
+       SET bytes = bytes + NEW.size_bytes - OLD.size_bytes
+     WHERE doctor_username = (SELECT doctor_username FROM patient_storage WHERE patient_id = NEW.patient_id);
+    UPDATE patient_storage
+       SET bytes = bytes + NEW.size_bytes - OLD.size_bytes
+     WHERE patient_id = NEW.patient_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS patient_storage_delete AFTER DELETE ON patient
+BEGIN
+    DELETE FROM patient_storage WHERE patient_id = OLD.id;
+END;
+"""
+
+
+def resolve_storage_path(storage_path):
+    """Map a storage_path from the image table to a file on disk (or None)"""
+    if not storage_path:
+        return None
+    for candidate in (Path(storage_path), BASE / storage_path.lstrip("/"), BASE / "database" / storage_path.lstrip("/")):
+        if candidate.exists():
+            return candidate
+    return None
+
+
+def init_storage_accounting():
+    """Add image.size_bytes and the usage tables, backfilling once from disk"""
+    with get_conn() as con:
+        has_image = con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'image'"
+        ).fetchone()
+        if not has_image:
+            # Database not initialised yet (see database/initdb.py)
+            return
+
+        has_usage = con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'doctor_storage'"
+        ).fetchone()
+        if has_usage:
+            con.executescript(STORAGE_SCHEMA)
+            # Rows left behind by patients deleted before patient_storage_delete existed
+            con.execute("DELETE FROM patient_storage WHERE patient_id NOT IN (SELECT id FROM patient)")
+            return
+
+        print("Adding image.size_bytes and backfilling storage usage...")
+        columns = [row["name"] for row in con.execute("PRAGMA table_info(image)")]
+        if "size_bytes" not in columns:
+            con.execute("ALTER TABLE image ADD COLUMN size_bytes INTEGER NOT NULL DEFAULT 0")
+        for row in con.execute("SELECT id, storage_path FROM image WHERE size_bytes = 0").fetchall():
+            file_path = resolve_storage_path(row["storage_path"])
+            if file_path:
+                con.execute("UPDATE image SET size_bytes = ? WHERE id = ?",
+                            (file_path.stat().st_size, row["id"]))
+        con.commit()
+
+        # Tables, triggers and the initial totals are created in one transaction so an
+        # interrupted start-up simply repeats the backfill next time
+        con.executescript("BEGIN;" + STORAGE_SCHEMA + """
+            INSERT INTO patient_storage (patient_id, doctor_username, bytes, image_count)
+            SELECT p.id, p.doctor_username, SUM(i.size_bytes), COUNT(*)
+            FROM image i INNER JOIN patient p ON i.patient_id = p.id
+            GROUP BY p.id;
+            INSERT INTO doctor_storage (doctor_username, bytes, image_count)
+            SELECT doctor_username, SUM(bytes), SUM(image_count)
+            FROM patient_storage
+            GROUP BY doctor_username;
+            COMMIT;
+        """)
+
+
+def get_doctor_usage(con, username):
+    """Return (bytes, image_count) for a doctor with a single primary-key lookup"""
+    row = con.execute(
+        "SELECT bytes, image_count FROM doctor_storage WHERE doctor_username = ?",
+        (username,)
+    ).fetchone()
+    return (row["bytes"], row["image_count"]) if row else (0, 0)
+
+
+def format_bytes(num_bytes):
+    """Human readable size, e.g. 1.5 GB"""
+    size = float(num_bytes)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+init_storage_accounting()
+
+
+#######status events
+# In-process pub/sub for job status (ingest, derivation, processing). Each open
+# /events stream gets its own bounded queue; when a slow browser falls behind the
+# oldest events are dropped rather than letting the buffer grow.
+EVENT_BUFFER_SIZE = 100
+EVENT_MAX_STREAMS_PER_USER = 5
+EVENT_KEEPALIVE_SECONDS = 15
+
+
+class StatusEventBroker:
+    """Fan out status events to every open stream of a user"""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.next_id = 0
+        self.dropped = 0
+        # publish() may run on worker threads while streams (un)subscribe on the loop
+        self.lock = threading.Lock()
+
+    def subscribe(self, username):
+        with self.lock:
+            streams = self.subscribers.setdefault(username, [])
+            if len(streams) >= EVENT_MAX_STREAMS_PER_USER:
+                return None
+            queue = asyncio.Queue(maxsize=EVENT_BUFFER_SIZE)
+            streams.append((asyncio.get_running_loop(), queue))
+            return queue
+
+    def stream_count(self, username):
+        with self.lock:
+            return len(self.subscribers.get(username, []))
+
+    def unsubscribe(self, username, queue):
+        with self.lock:
+            streams = [s for s in self.subscribers.get(username, []) if s[1] is not queue]
+            if streams:
+                self.subscribers[username] = streams
+            else:
+                self.subscribers.pop(username, None)
+
+    def _deliver(self, queue, event):
+        if queue.full():
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait(event)
+
+    def publish(self, username, kind, status, **data):
+        """Send an event to a user's streams; safe to call from worker threads"""
+        with self.lock:
+            self.next_id += 1
+            event = {"id": self.next_id, "kind": kind, "status": status, "time": int(time.time()), **data}
+            streams = list(self.subscribers.get(username, []))
+        for loop, queue in streams:
+            loop.call_soon_threadsafe(self._deliver, queue, event)
+
+
+events = StatusEventBroker()
+
 #######webpages
 # Homepage route - serves HTML with Jinja
 @app.get("/")
@@ -91,12 +432,22 @@ async def dashboard(request: Request):
     # Get any messages from URL params
     message = request.query_params.get("message")
 
+    # Storage usage is a single primary-key lookup on the running totals
+    with get_conn() as con:
+        used_bytes, image_count = get_doctor_usage(con, user["username"])
+
     context = {
         "request": request,
         "app_name": "Image Processing App",
         "user": user,
         "message": message,
-        "current_page": "dashboard"  # Add this to highlight active nav item
+        "current_page": "dashboard",  # Add this to highlight active nav item
+        "storage": {
+            "used": format_bytes(used_bytes),
+            "image_count": image_count,
+            "quota": format_bytes(DOCTOR_QUOTA_BYTES) if DOCTOR_QUOTA_BYTES else None,
+            "percent": min(100, round(100 * used_bytes / DOCTOR_QUOTA_BYTES)) if DOCTOR_QUOTA_BYTES else None,
+        },
     }
     return templates.TemplateResponse("dashboard/dashboard.html", context)
 
@@ -134,6 +485,17 @@ async def create_patient(request: Request):
     if not user:
         return RedirectResponse("/?error=Please+log+in+first", status_code=303)
 
+    # Reject oversized uploads from Content-Length before the body is spooled to disk
+    content_length = int(request.headers.get("content-length") or 0)
+    with get_conn() as con:
+        used_bytes, _ = get_doctor_usage(con, user['username'])
+    if DOCTOR_QUOTA_BYTES and used_bytes + content_length > DOCTOR_QUOTA_BYTES:
+        message = f"Upload exceeds your storage quota ({format_bytes(used_bytes)} of {format_bytes(DOCTOR_QUOTA_BYTES)} used)"
+        return RedirectResponse(f"/new-patient?error={quote_plus(message)}", status_code=303)
+    if PATIENT_QUOTA_BYTES and content_length > PATIENT_QUOTA_BYTES:
+        message = f"Upload exceeds the per-patient quota of {format_bytes(PATIENT_QUOTA_BYTES)}"
+        return RedirectResponse(f"/new-patient?error={quote_plus(message)}", status_code=303)
+
     try:
         # Parse form data manually to handle multiple images
         form_data = await request.form()
@@ -165,7 +527,12 @@ async def create_patient(request: Request):
                 (user['username'], patient_code, birthdate, sex, clinical_diagnosis, timestamp, timestamp))
 
             patient_id = cursor.lastrowid
+            events.publish(user['username'], "ingest", "started", patient_code=patient_code)
             images_saved = 0
+            images_over_quota = 0
+            # image_saved events name rows by id, so they are only sent once committed
+            saved_events = []
+            patient_bytes = 0
 
             # Handle image uploads if action includes images
             if action == "patient_and_images":
@@ -206,12 +573,25 @@ async def create_patient(request: Request):
 
                                 # Read and save file
                                 contents = await image_file.read()
-                                
+
+                                # Content-Length covers the whole request, so re-check each file
+                                # against the quotas before writing it
+                                size_bytes = len(contents)
+                                doctor_bytes, _ = get_doctor_usage(con, user['username'])
+                                if (DOCTOR_QUOTA_BYTES and doctor_bytes + size_bytes > DOCTOR_QUOTA_BYTES) or \
+                                        (PATIENT_QUOTA_BYTES and patient_bytes + size_bytes > PATIENT_QUOTA_BYTES):
+                                    print(f"❌ Image {image_index} skipped: storage quota exceeded")
+                                    events.publish(user['username'], "ingest", "image_skipped", patient_code=patient_code,
+                                                   image_index=image_index, message="Storage quota exceeded")
+                                    images_over_quota += 1
+                                    image_index += 1
+                                    continue
+
                                 # Make sure the directory exists
                                 storage_path.parent.mkdir(parents=True, exist_ok=True)
                                 
-                                with open(storage_path, "wb") as f:
-                                    f.write(contents)
+                                # Large volumes are written on a worker thread so the event loop stays free
+                                await run_in_threadpool(storage_path.write_bytes, contents)
 
                                 # Verify file was saved and has content
                                 if storage_path.exists() and storage_path.stat().st_size > 0:
@@ -220,18 +600,28 @@ async def create_patient(request: Request):
                                     
                                     # Insert image record with relative path for portability
                                     relative_path = f"database/Images/uploaded/{unique_filename}"
-                                    con.execute("""
-                                        INSERT INTO image (patient_id, uploader_username, mri_date, image_name, storage_path, modality, notes, created_at, updated_at)
-                                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                    """, (patient_id, user['username'], mri_date, unique_filename, relative_path, modality, image_notes, timestamp, timestamp))
+                                    image_cursor = con.execute("""
+                                        INSERT INTO image (patient_id, uploader_username, mri_date, image_name, storage_path, modality, notes, size_bytes, created_at, updated_at)
+                                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                    """, (patient_id, user['username'], mri_date, unique_filename, relative_path, modality, image_notes, size_bytes, timestamp, timestamp))
                                     
                                     images_saved += 1
+                                    patient_bytes += size_bytes
+                                    saved_events.append(dict(patient_code=patient_code,
+                                                             image_index=image_index, image_id=image_cursor.lastrowid,
+                                                             image_name=unique_filename, mri_date=mri_date, modality=modality,
+                                                             url=f"/images/{image_cursor.lastrowid}/{unique_filename}",
+                                                             size_bytes=size_bytes))
                                     print(f"✅ Database record created for image {image_index + 1}")
                                 else:
                                     print(f"❌ Failed to save image file: {storage_path}")
+                                    events.publish(user['username'], "ingest", "image_failed", patient_code=patient_code,
+                                                   image_index=image_index, message="File could not be saved")
                                     
                             except Exception as e:
                                 print(f"❌ Error processing image {image_index}: {e}")
+                                events.publish(user['username'], "ingest", "image_failed", patient_code=patient_code,
+                                               image_index=image_index, message="Error processing image")
                                 import traceback
                                 traceback.print_exc()
                         
@@ -244,12 +634,22 @@ async def create_patient(request: Request):
                     message += f" with {images_saved} image{'s' if images_saved != 1 else ''} uploaded"
                 else:
                     message += " (no images were uploaded)"
+                if images_over_quota > 0:
+                    message += f"; {images_over_quota} image{'s' if images_over_quota != 1 else ''} skipped (storage quota exceeded)"
+
+            # Commit before announcing saved images so listeners never see rows that could still roll back
+            con.commit()
+            for saved in saved_events:
+                events.publish(user['username'], "ingest", "image_saved", **saved)
+            events.publish(user['username'], "ingest", "completed", patient_code=patient_code,
+                           images_saved=images_saved, message=message)
 
             # Use proper URL encoding
             return RedirectResponse(f"/new-patient?message={quote_plus(message)}", status_code=303)
 
     except Exception as e:
         print(f"Error creating patient: {e}")
+        events.publish(user['username'], "ingest", "failed", message="Failed to save patient")
         import traceback
         traceback.print_exc()
         # Use proper URL encoding for error message too
@@ -291,9 +691,9 @@ async def view_patients(request: Request):
         row = dict(row)
         storage_path = row.get("storage_path")
         print(storage_path)
-        # Build URL from storage_path
+        # Served through /images so the warm cache can prefetch the rest of the patient
         if storage_path:
-            image_url =  storage_path
+            image_url = f"/images/{row['image_id']}/{row['image_name']}"
         else:
             image_url = None
 
@@ -349,6 +749,177 @@ async def _serve_image_by_id(image_id: int):
             )
 
     return FileResponse(file_path)
+#######warm image cache
+# Opening one image in the viewer usually means the patient's other modalities and
+# earlier timepoints come next, so they are read into a byte-budgeted LRU in the
+# background. Files are cached as stored; NIfTI decompression stays in the browser.
+WARM_CACHE_BYTES = int(os.environ.get("IMAGULATOR_WARM_CACHE_BYTES", str(512 * 1024 * 1024)))
+# A single prefetch batch may use at most this share of the budget, so it cannot
+# evict the image that triggered it
+WARM_CACHE_PREFETCH_SHARE = 0.5
+WARM_CACHE_PREFETCH_WORKERS = 2
+
+
+class WarmImageCache:
+    """Thread-safe LRU of image file contents keyed by storage_path"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.prefetching = set()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "prefetched": 0}
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return data
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            requests = self.counters["hits"] + self.counters["misses"]
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hit_rate": self.counters["hits"] / requests if requests else None,
+                **self.counters,
+            }
+
+
+warm_cache = WarmImageCache(WARM_CACHE_BYTES)
+# Prefetch runs on its own threads, outside the request, so it never holds an
+# admission slot or the user's in-flight permit after the response is sent
+prefetch_executor = ThreadPoolExecutor(max_workers=WARM_CACHE_PREFETCH_WORKERS, thread_name_prefix="warm-cache")
+
+
+def prefetch_patient_images(patient_id, image_id, mri_date):
+    """Read a patient's other images into the warm cache: same-day modalities, then
+    earlier timepoints (most recent first), then later ones (nearest first)"""
+    with warm_cache.lock:
+        if patient_id in warm_cache.prefetching:
+            return
+        warm_cache.prefetching.add(patient_id)
+
+    try:
+        with get_conn() as con:
+            rows = con.execute(
+                """
+                SELECT id, storage_path, size_bytes
+                FROM image
+                WHERE patient_id = ? AND id != ?
+                ORDER BY (mri_date = ?) DESC, (mri_date < ?) DESC,
+                         CASE WHEN mri_date < ? THEN mri_date END DESC,
+                         CASE WHEN mri_date > ? THEN mri_date END ASC,
+                         modality, id
+                """,
+                (patient_id, image_id, mri_date, mri_date, mri_date, mri_date)
+            ).fetchall()
+
+        budget = WARM_CACHE_BYTES * WARM_CACHE_PREFETCH_SHARE
+        for row in rows:
+            if row["storage_path"] in warm_cache:
+                continue
+            if row["size_bytes"] > budget:
+                # Smaller images further down the list may still fit
+                continue
+            file_path = resolve_storage_path(row["storage_path"])
+            if not file_path:
+                continue
+            data = file_path.read_bytes()
+            warm_cache.put(row["storage_path"], data)
+            budget -= len(data)
+            with warm_cache.lock:
+                warm_cache.counters["prefetched"] += 1
+    except Exception as e:
+        print(f"❌ Error prefetching images for patient {patient_id}: {e}")
+    finally:
+        with warm_cache.lock:
+            warm_cache.prefetching.discard(patient_id)
+
+
+@app.api_route("/images/{image_id}/{filename}", methods=["GET", "HEAD"])
+async def serve_image(request: Request, image_id: int, filename: str):
+    """Serve an image file by id from the warm cache, prefetching the patient's other images"""
+    user = get_current_user(request)
+    if not user:
+        raise HTTPException(status_code=401, detail="Please log in first")
+
+    with get_conn() as con:
+        row = con.execute(
+            """
+            SELECT i.patient_id, i.mri_date, i.image_name, i.storage_path
+            FROM image i
+                     INNER JOIN patient p ON i.patient_id = p.id
+            WHERE i.id = ? AND p.doctor_username = ?
+            """,
+            (image_id, user["username"])
+        ).fetchone()
+
+    if not row:
+        raise HTTPException(status_code=404, detail="Image not found in database")
+
+    media_type = mimetypes.guess_type(row["image_name"] or filename)[0] or "application/octet-stream"
+    headers = {"Cache-Control": "private, max-age=3600"}
+
+    # papaya_simple.js sends a HEAD before every GET; answer it from stat() so it
+    # neither reads the file nor skews the hit/miss counters or starts a prefetch
+    if request.method == "HEAD":
+        file_path = resolve_storage_path(row["storage_path"])
+        if not file_path:
+            raise HTTPException(status_code=404, detail=f"Image file not found: {row['storage_path']}")
+        headers["Content-Length"] = str(file_path.stat().st_size)
+        return Response(media_type=media_type, headers=headers)
+
+    prefetch_executor.submit(prefetch_patient_images, row["patient_id"], image_id, row["mri_date"])
+
+    data = warm_cache.get(row["storage_path"])
+    if data is None:
+        file_path = resolve_storage_path(row["storage_path"])
+        if not file_path:
+            raise HTTPException(status_code=404, detail=f"Image file not found: {row['storage_path']}")
+        # Files that could never fit in the cache are streamed rather than held in memory
+        if file_path.stat().st_size > warm_cache.max_bytes:
+            return FileResponse(file_path, media_type=media_type, headers=headers)
+        data = await run_in_threadpool(file_path.read_bytes)
+        warm_cache.put(row["storage_path"], data)
+
+    return Response(data, media_type=media_type, headers=headers)
+
+
+@app.get("/api/warm-cache-stats")
+async def warm_cache_stats(request: Request):
+    """Hit/miss counters and memory use of the warm image cache"""
+    user = get_current_user(request)
+    if not user:
+        return JSONResponse({"error": "Please log in first"}, status_code=401)
+
+    return JSONResponse(warm_cache.stats())
+
+
 @app.get("/papaya")
 async def papaya_viewer(request: Request):
     user = get_current_user(request)
@@ -367,6 +938,309 @@ async def papaya_viewer(request: Request):
     return templates.TemplateResponse("papaya.html", context)
 
 
+@app.get("/events")
+async def status_events(request: Request):
+    """Server-Sent Events stream of job status for the logged-in user"""
+    user = get_current_user(request)
+    if not user:
+        return JSONResponse({"error": "Please log in first"}, status_code=401)
+
+    username = user["username"]
+    if events.stream_count(username) >= EVENT_MAX_STREAMS_PER_USER:
+        return JSONResponse({"error": "Too many open event streams"}, status_code=429,
+                            headers={"Retry-After": str(EVENT_KEEPALIVE_SECONDS)})
+
+    async def stream():
+        # Subscribe only once the body is being sent: if the client goes away before
+        # that, the generator never runs and there is nothing to clean up
+        queue = events.subscribe(username)
+        if queue is None:
+            yield f"retry: {EVENT_KEEPALIVE_SECONDS * 1000}\n\n"
+            return
+        try:
+            yield f"retry: {EVENT_KEEPALIVE_SECONDS * 1000}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event['id']}\nevent: {event['kind']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            events.unsubscribe(username, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+#######roi statistics
+# Volumes are read in slabs along the last spatial axis: uncompressed .nii files are
+# memory-mapped by nibabel and .nii.gz files are decompressed slab by slab. Statistics
+# are accumulated per slab (mean/std with a chunked Welford update; percentiles in a
+# second pass, exact for small ROIs and from a fixed-size histogram otherwise), so
+# memory is bounded by about one slab whatever the size of the ROI.
+ROI_CHUNK_SLICES = 16
+ROI_HISTOGRAM_BINS = 65536
+# ROIs up to this many voxels (roughly one 512x512x16 slab) get exact percentiles
+ROI_EXACT_VOXELS = 512 * 512 * 16
+ROI_MAX_BATCH = 50
+ROI_DEFAULT_PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def load_volume(file_path):
+    """Return (array-like, voxel sizes in mm) for a NIfTI or 2D image file"""
+    name = file_path.name.lower()
+    if name.endswith(".nii") or name.endswith(".gz"):
+        if name.endswith(".nii") or name.endswith(".nii.gz"):
+            img = nib.load(str(file_path), mmap=True)
+        else:
+            # Older uploads were stored as bare .gz, which nib.load cannot identify;
+            # nibabel's opener still picks gzip from the suffix
+            holder = lambda: nib.FileHolder(filename=str(file_path))
+            img = nib.Nifti1Image.from_file_map({"header": holder(), "image": holder()})
+        zooms = tuple(float(z) for z in img.header.get_zooms()[:3])
+        zooms = zooms + (1.0,) * (3 - len(zooms))
+        return img.dataobj, zooms
+
+    # Plain 2D images (png/jpeg) become a single-slice volume
+    with Image.open(file_path) as im:
+        data = np.asarray(im.convert("F"))
+    return data.T[:, :, np.newaxis], (1.0, 1.0, 1.0)
+
+
+def read_block(volume, x, y, z):
+    """Read volume[x, y, z] as float64, taking the first frame of 4D data"""
+    extra = (0,) * (len(volume.shape) - 3)
+    if len(volume.shape) == 2:
+        return np.asarray(volume[x, y], dtype=np.float64)[:, :, np.newaxis]
+    return np.asarray(volume[(x, y, z) + extra], dtype=np.float64)
+
+
+def volume_shape(volume):
+    shape = tuple(volume.shape[:3])
+    return shape + (1,) * (3 - len(shape))
+
+
+def get_owned_image_path(con, username, image_id):
+    """Resolve an image id to a file on disk, only for images of this doctor's patients"""
+    row = con.execute(
+        """
+        SELECT i.storage_path
+        FROM image i
+                 INNER JOIN patient p ON i.patient_id = p.id
+        WHERE i.id = ? AND p.doctor_username = ?
+        """,
+        (image_id, username)
+    ).fetchone()
+    if not row:
+        raise ValueError(f"Image {image_id} not found")
+    file_path = resolve_storage_path(row["storage_path"])
+    if not file_path:
+        raise ValueError(f"Image file for {image_id} not found on disk")
+    return file_path
+
+
+def roi_coords(values, label):
+    """Validate an [x, y, z] coordinate list from the request"""
+    if not isinstance(values, (list, tuple)) or len(values) != 3:
+        raise ValueError(f"{label} must be a list of 3 voxel coordinates")
+    return [float(v) for v in values]
+
+
+def roi_bounds(item, shape, zooms):
+    """Return the voxel bounding box (lo, hi) of the ROI and an optional sphere test"""
+    if "box" in item:
+        lo = [max(0, int(v)) for v in roi_coords(item["box"]["min"], "box.min")]
+        hi = [min(n, int(v) + 1) for v, n in zip(roi_coords(item["box"]["max"], "box.max"), shape)]
+        return lo, hi, None
+
+    if "sphere" in item:
+        center = roi_coords(item["sphere"]["center"], "sphere.center")
+        radius_mm = float(item["sphere"]["radius_mm"])
+        reach = [radius_mm / z for z in zooms]
+        lo = [max(0, int(np.floor(c - r))) for c, r in zip(center, reach)]
+        hi = [min(n, int(np.ceil(c + r)) + 1) for c, r, n in zip(center, reach, shape)]
+        return lo, hi, (center, radius_mm)
+
+    # Whole volume (restricted by the mask, if any)
+    return [0, 0, 0], list(shape), None
+
+
+def compute_roi_stats(con, username, item, percentiles):
+    """Voxel count, physical volume and intensity statistics for one ROI request"""
+    image_id = int(item["image_id"])
+    volume, zooms = load_volume(get_owned_image_path(con, username, image_id))
+    shape = volume_shape(volume)
+
+    mask = None
+    if item.get("mask_image_id") is not None:
+        mask, _ = load_volume(get_owned_image_path(con, username, int(item["mask_image_id"])))
+        if volume_shape(mask) != shape:
+            raise ValueError(f"Mask shape {volume_shape(mask)} does not match image shape {shape}")
+
+    lo, hi, sphere = roi_bounds(item, shape, zooms)
+    if any(h <= l for l, h in zip(lo, hi)):
+        raise ValueError("ROI lies outside the image")
+
+    voxel_volume = float(np.prod(zooms))
+    result = {
+        "image_id": image_id,
+        "voxel_count": 0,
+        "voxel_volume_mm3": voxel_volume,
+        "volume_mm3": 0.0,
+    }
+
+    # First pass: count, mean, M2 (chunked Welford), min and max
+    count, mean, m2 = 0, 0.0, 0.0
+    lowest, highest = np.inf, -np.inf
+    for selected in iter_roi_values(volume, mask, lo, hi, sphere, zooms):
+        n = selected.size
+        chunk_mean = float(selected.mean())
+        chunk_m2 = float(np.square(selected - chunk_mean).sum())
+        delta = chunk_mean - mean
+        total = count + n
+        mean += delta * n / total
+        m2 += chunk_m2 + delta ** 2 * count * n / total
+        count = total
+        lowest = min(lowest, float(selected.min()))
+        highest = max(highest, float(selected.max()))
+
+    if count == 0:
+        result.update({"mean": None, "std": None, "min": None, "max": None,
+                       "percentiles": {f"{p:g}": None for p in percentiles}})
+        return result
+
+    result.update({
+        "voxel_count": count,
+        "volume_mm3": count * voxel_volume,
+        "mean": mean,
+        "std": float(np.sqrt(m2 / count)),
+        "min": lowest,
+        "max": highest,
+        "percentiles": histogram_percentiles(volume, mask, lo, hi, sphere, zooms,
+                                             count, lowest, highest, percentiles),
+    })
+    return result
+
+
+def iter_roi_values(volume, mask, lo, hi, sphere, zooms):
+    """Yield the ROI voxels slab by slab as flat float64 arrays"""
+    x, y = slice(lo[0], hi[0]), slice(lo[1], hi[1])
+    if sphere:
+        (cx, cy, cz), radius_mm = sphere
+        dx = ((np.arange(lo[0], hi[0]) - cx) * zooms[0])[:, None, None]
+        dy = ((np.arange(lo[1], hi[1]) - cy) * zooms[1])[None, :, None]
+
+    for z0 in range(lo[2], hi[2], ROI_CHUNK_SLICES):
+        z1 = min(z0 + ROI_CHUNK_SLICES, hi[2])
+        block = read_block(volume, x, y, slice(z0, z1))
+        inside = np.ones(block.shape, dtype=bool)
+        if mask is not None:
+            inside &= read_block(mask, x, y, slice(z0, z1)) > 0
+        if sphere:
+            dz = ((np.arange(z0, z1) - cz) * zooms[2])[None, None, :]
+            inside &= dx ** 2 + dy ** 2 + dz ** 2 <= radius_mm ** 2
+
+        selected = block[inside]
+        if selected.size:
+            yield selected
+
+
+def histogram_percentiles(volume, mask, lo, hi, sphere, zooms, count, lowest, highest, percentiles):
+    """
+    Second pass: percentiles with the same linear interpolation as np.percentile.
+    ROIs of up to ROI_EXACT_VOXELS (about one slab) are collected and computed
+    exactly. Larger ROIs use a fixed histogram over [min, max]: the two order
+    statistics either side of each rank are located to within one bin width,
+    (max - min) / ROI_HISTOGRAM_BINS, and interpolated between.
+    """
+    if lowest == highest:
+        return {f"{p:g}": lowest for p in percentiles}
+
+    if count <= ROI_EXACT_VOXELS:
+        values = np.concatenate(list(iter_roi_values(volume, mask, lo, hi, sphere, zooms)))
+        return {f"{p:g}": float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))}
+
+    counts = np.zeros(ROI_HISTOGRAM_BINS, dtype=np.int64)
+    for selected in iter_roi_values(volume, mask, lo, hi, sphere, zooms):
+        counts += np.histogram(selected, bins=ROI_HISTOGRAM_BINS, range=(lowest, highest))[0]
+
+    cumulative = np.cumsum(counts)
+    width = (highest - lowest) / ROI_HISTOGRAM_BINS
+
+    def order_statistic(k):
+        # Value of the k-th smallest voxel (0-based), placed evenly inside its bin
+        b = int(np.searchsorted(cumulative, k, side="right"))
+        before = cumulative[b - 1] if b > 0 else 0
+        value = lowest + (b + (k - before + 0.5) / counts[b]) * width
+        return min(max(value, lowest), highest)
+
+    result = {}
+    for p in percentiles:
+        rank = p / 100 * (count - 1)
+        below = int(np.floor(rank))
+        above = min(below + 1, count - 1)
+        low_value = order_statistic(below)
+        value = low_value + (rank - below) * (order_statistic(above) - low_value)
+        result[f"{p:g}"] = float(value)
+    return result
+
+
+@app.post("/api/roi-stats")
+def roi_stats(request: Request, payload: dict = Body(...)):
+    """
+    Region statistics for one or more images, e.g.
+    {"items": [{"image_id": 1, "mask_image_id": 2},
+               {"image_id": 1, "box": {"min": [10, 10, 5], "max": [40, 40, 20]}},
+               {"image_id": 3, "sphere": {"center": [64, 64, 30], "radius_mm": 8}}],
+     "percentiles": [5, 50, 95]}
+    Box/sphere coordinates are voxel indices, the sphere radius is in mm.
+    """
+    user = get_current_user(request)
+    if not user:
+        return JSONResponse({"error": "Please log in first"}, status_code=401)
+
+    items = payload.get("items", [payload] if "image_id" in payload else [])
+    if not items:
+        return JSONResponse({"error": "No images requested"}, status_code=400)
+    if len(items) > ROI_MAX_BATCH:
+        return JSONResponse({"error": f"At most {ROI_MAX_BATCH} images per request"}, status_code=400)
+
+    try:
+        percentiles = [float(p) for p in payload.get("percentiles", ROI_DEFAULT_PERCENTILES)]
+        if any(p < 0 or p > 100 for p in percentiles):
+            raise ValueError
+    except (TypeError, ValueError):
+        return JSONResponse({"error": "Percentiles must be numbers between 0 and 100"}, status_code=400)
+
+    results = []
+    with get_conn() as con:
+        for item in items:
+            try:
+                results.append(compute_roi_stats(con, user["username"], item, percentiles))
+            except (KeyError, TypeError, ValueError) as e:
+                results.append({"image_id": item.get("image_id") if isinstance(item, dict) else None,
+                                "error": str(e)})
+            except Exception as e:
+                print(f"❌ Error computing ROI stats for {item}: {e}")
+                import traceback
+                traceback.print_exc()
+                results.append({"image_id": item.get("image_id"), "error": "Failed to read image"})
+
+    return JSONResponse({"results": results})
+
+
+@app.get("/api/admission-stats")
+async def admission_stats(request: Request):
+    """Queue depth, in-flight requests and rejection counters per route class"""
+    user = get_current_user(request)
+    if not user:
+        return JSONResponse({"error": "Please log in first"}, status_code=401)
+
+    return JSONResponse(admission.stats())
+
+
 # Handle sign up
 @app.post("/signup")
 def signup(request: Request, email: str = Form(...), username: str = Form(...), password: str = Form(...)):
@@ -260,12 +260,38 @@ class ImageUploadManager {
     }
 }
 
+/**
+ * Live ingest status over Server-Sent Events (/events)
+ */
+function listenForStatusEvents(manager) {
+    if (typeof EventSource === 'undefined') return null;
+
+    const source = new EventSource('/events');
+    source.addEventListener('ingest', (e) => {
+        const event = JSON.parse(e.data);
+        switch (event.status) {
+            case 'started':
+                manager.showAlert(`Saving patient ${event.patient_code}...`, 'info');
+                break;
+            case 'image_saved':
+                manager.showAlert(`Image #${event.image_index + 1} (${event.modality}) saved`, 'success');
+                break;
+            case 'image_skipped':
+            case 'image_failed':
+                manager.showAlert(`Image #${event.image_index + 1}: ${event.message}`, 'warning');
+                break;
+        }
+    });
+    return source;
+}
+
 // Global instance
 let imageUploadManager;
 
 // Initialize when DOM is loaded
 document.addEventListener('DOMContentLoaded', function() {
     imageUploadManager = new ImageUploadManager();
+    listenForStatusEvents(imageUploadManager);
 
     // Form submission validation
     const form = document.querySelector('form[action="/new-patient"]');
@@ -31,45 +31,46 @@ document.addEventListener('DOMContentLoaded', function() {
         console.log('  Image', index + 1, ':', url);
     });
 
-    imageSelectors.forEach(function(item, index) {
-        item.addEventListener('click', function(e) {
-            e.preventDefault();
-            console.log('\n=== IMAGE CLICKED ===');
-            console.log('Image index:', index + 1);
-
-            var imageUrl = this.getAttribute('url');
-            console.log('Image URL:', imageUrl);
-
-            if (!imageUrl || imageUrl === 'None' || imageUrl === 'null') {
-                console.error('ERROR: Invalid URL');
-                alert('Invalid image URL: ' + imageUrl);
-                return;
-            }
-
-            // Test if URL is accessible
-            console.log('Testing URL accessibility...');
-            fetch(imageUrl, { method: 'HEAD' })
-                .then(function(response) {
-                    console.log('URL test response status:', response.status);
-                    if (response.ok) {
-                        console.log('✓ URL is accessible');
-                        loadImage(imageUrl);
-                    } else {
-                        console.error('✗ URL returned error:', response.status);
-                        alert('Image URL returned error: ' + response.status);
-                    }
-                })
-                .catch(function(error) {
-                    console.error('✗ URL test failed:', error);
-                    alert('Cannot access image URL: ' + error.message);
-                });
-
-            // Highlight selected
-            imageSelectors.forEach(function(el) {
-                el.classList.remove('active');
+    // Delegated so items added live (see patients_live.js) work too
+    document.addEventListener('click', function(e) {
+        var item = e.target.closest('.image-selector');
+        if (!item) return;
+
+        e.preventDefault();
+        console.log('\n=== IMAGE CLICKED ===');
+
+        var imageUrl = item.getAttribute('url');
+        console.log('Image URL:', imageUrl);
+
+        if (!imageUrl || imageUrl === 'None' || imageUrl === 'null') {
+            console.error('ERROR: Invalid URL');
+            alert('Invalid image URL: ' + imageUrl);
+            return;
+        }
+
+        // Test if URL is accessible
+        console.log('Testing URL accessibility...');
+        fetch(imageUrl, { method: 'HEAD' })
+            .then(function(response) {
+                console.log('URL test response status:', response.status);
+                if (response.ok) {
+                    console.log('✓ URL is accessible');
+                    loadImage(imageUrl);
+                } else {
+                    console.error('✗ URL returned error:', response.status);
+                    alert('Image URL returned error: ' + response.status);
+                }
+            })
+            .catch(function(error) {
+                console.error('✗ URL test failed:', error);
+                alert('Cannot access image URL: ' + error.message);
             });
-            this.classList.add('active');
+
+        // Highlight selected
+        document.querySelectorAll('.image-selector').forEach(function(el) {
+            el.classList.remove('active');
         });
+        item.classList.add('active');
     });
 
     console.log('=== Setup complete ===\n');
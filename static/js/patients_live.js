@@ -0,0 +1,70 @@
+/**
+ * Patients page - live updates
+ * Adds newly uploaded images to the sidebar as ingest events arrive on /events,
+ * instead of polling the server for changes
+ */
+
+document.addEventListener('DOMContentLoaded', function() {
+    if (typeof EventSource === 'undefined') return;
+
+    var source = new EventSource('/events');
+    source.addEventListener('ingest', function(e) {
+        var event = JSON.parse(e.data);
+        if (event.status === 'image_saved') {
+            addImageToList(event);
+        }
+    });
+});
+
+function getImageList() {
+    var list = document.getElementById('image-list');
+    if (list) return list;
+
+    // First image: replace the "No images found" card with an empty list
+    var emptyCard = document.getElementById('no-images-card');
+    list = document.createElement('div');
+    list.id = 'image-list';
+    list.className = 'list-group list-group-flush';
+    if (emptyCard) {
+        emptyCard.replaceWith(list);
+    }
+    return list;
+}
+
+function addImageToList(event) {
+    var list = getImageList();
+    if (list.querySelector('[data-image-id="' + event.image_id + '"]')) return;
+
+    var item = document.createElement('a');
+    item.href = '#';
+    item.className = 'list-group-item list-group-item-action d-flex justify-content-between align-items-center image-selector';
+    item.setAttribute('url', event.url);
+    item.setAttribute('data-image-id', event.image_id);
+    item.setAttribute('data-patient-code', event.patient_code);
+
+    var label = document.createElement('span');
+    var code = document.createElement('span');
+    code.className = 'text-primary fw-bold';
+    code.textContent = event.patient_code;
+    label.appendChild(code);
+    if (event.mri_date) {
+        var date = document.createElement('span');
+        date.className = 'text-muted';
+        date.textContent = ' [' + event.mri_date + ']';
+        label.appendChild(date);
+    }
+    label.appendChild(document.createElement('br'));
+    var name = document.createElement('small');
+    name.textContent = event.image_name;
+    label.appendChild(name);
+    item.appendChild(label);
+
+    if (event.modality) {
+        var badge = document.createElement('span');
+        badge.className = 'badge rounded-pill bg-primary';
+        badge.textContent = event.modality;
+        item.appendChild(badge);
+    }
+
+    list.insertBefore(item, list.firstChild);
+}